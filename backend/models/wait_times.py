@@ -4,18 +4,47 @@ from . import util, config
 from datetime import date
 import sys
 import re
+import bisect
 import requests
 from pathlib import Path
 import json
+import functools
+import os
+import uuid
+
+# orjson parses large JSON files several times faster than the json module;
+# fall back to the json module if it is not installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 def get_stats(time_values, start_time=None, end_time=None):
     return WaitTimeStats(time_values, start_time, end_time)
 
+def get_stats_batch(time_values, start_times, end_times):
+    return BatchWaitTimeStats(time_values, start_times, end_times)
+
+def get_stats_for_stops(time_values, stop_offsets, start_time=None, end_time=None):
+    # Returns a BatchWaitTimeStats with one interval per stop, given the sorted time values for all stops
+    # concatenated into a single array, where the time values for stop i are
+    # time_values[stop_offsets[i]:stop_offsets[i+1]].
+    # stop_offsets must start at 0 and end at len(time_values).
+    # (one interval per pair of consecutive offsets; invalid offsets are rejected by BatchWaitTimeStats)
+    num_stops = len(stop_offsets[1:])
+    start_times = np.full(num_stops, np.nan if start_time is None else start_time, dtype=float)
+    end_times = np.full(num_stops, np.nan if end_time is None else end_time, dtype=float)
+    return BatchWaitTimeStats(time_values, start_times, end_times, stop_offsets)
+
 # WaitTimeStats allows computing statistics about wait times within an interval,
 # (such as averages, percentiles, and histograms),
 # given a sorted array of arrival or departure times (Unix timestamps in seconds),
 # and optional start and end timestamps.
 #
+# time_values must be sorted in ascending order; this is not checked, and the
+# first/last bus times and the binary searches for the interval bounds rely on it.
+#
 # It assumes that a person has an equal probability of showing up at the stop at
 # any time within the interval.
 #
@@ -101,16 +130,28 @@ def get_stats(time_values, start_time=None, end_time=None):
 #
 class WaitTimeStats:
     def __init__(self, time_values, start_time = None, end_time = None):
-        self.time_values = time_values
+        # time_values may be any sequence (e.g. a list); it is converted to a numpy array
+        time_values = self.time_values = np.asarray(time_values)
+
+        # results of get_quantiles and get_histogram, keyed by tuple of quantiles/bins,
+        # so that repeated requests for the same stats do not need to be recomputed.
+        # copies are returned to callers so that modifying a result does not change the cached value.
+        self._quantiles_cache = {}
+        self._histogram_cache = {}
+
+        # CDF is stored as separate contiguous arrays of wait times (minutes) and cumulative probabilities,
+        # computed lazily by _get_cdf_domain_and_range
+        self._cdf_domain = None
+        self._cdf_range = None
+        self._cdf_points = None
 
         if len(time_values) == 0:
             self.is_empty = True
             return
 
-        self.cdf_points = None
-
-        first_bus_time = np.min(time_values)
-        last_bus_time = np.max(time_values)
+        # time_values must be sorted, so the first and last bus times are at the ends of the array
+        first_bus_time = time_values[0]
+        last_bus_time = time_values[-1]
 
         # if start_time/end_time is outside the range of arrival times, limit interval to first/last arrival time
         interval_start = self.interval_start = int(
@@ -127,7 +168,20 @@ class WaitTimeStats:
 
         if end_arrival_index > start_arrival_index:
             self.interval_time_values = interval_time_values = time_values[start_arrival_index:end_arrival_index]
-            self.interval_headways = np.diff(interval_time_values, prepend=interval_start)
+
+            # headways are differences between timestamps, so if the timestamps are integers,
+            # the headways fit in 32-bit integers, using half the memory of 64-bit timestamps
+            # for the sort and reductions over the headways
+            if np.issubdtype(interval_time_values.dtype, np.integer):
+                headway_dtype = np.int32
+            else:
+                headway_dtype = interval_time_values.dtype
+
+            # equivalent to np.diff(interval_time_values, prepend=interval_start),
+            # without allocating a temporary array with interval_start prepended
+            interval_headways = self.interval_headways = np.empty(len(interval_time_values), dtype=headway_dtype)
+            interval_headways[0] = interval_time_values[0] - interval_start
+            np.subtract(interval_time_values[1:], interval_time_values[:-1], out=interval_headways[1:])
 
             # end elapsed_time is the number of seconds between when the last bus arrives within this interval and the end of the interval
             self.end_elapsed_time = interval_end - self.interval_time_values[-1]
@@ -155,23 +209,48 @@ class WaitTimeStats:
 
         if len(self.interval_headways) > 0:
             # for the time between each bus that arrives within the interval, total wait time is area of a triangle
-            total_wait += np.sum(np.square(self.interval_headways))/2
+            # (dot product computes the sum of squares without allocating an array of squared headways;
+            # sums are accumulated as 64-bit values since squares of 32-bit headways may overflow 32 bits)
+            interval_headways = self.interval_headways
+            total_wait += float(np.einsum(
+                'i,i->', interval_headways, interval_headways, dtype=np.result_type(interval_headways, np.int64)
+            ))/2
 
         if self.end_wait_time is not None:
             # for the next arrival after the end of the interval,
             # total wait time is the area of a rectangle plus the area of a triangle
-            total_wait += (self.end_wait_time * self.end_elapsed_time) + (self.end_elapsed_time ** 2)/2
+            # (computed as floats, since products of 32-bit integer times may overflow 32 bits)
+            end_wait_time = float(self.end_wait_time)
+            end_elapsed_time = float(self.end_elapsed_time)
+            total_wait += (end_wait_time * end_elapsed_time) + (end_elapsed_time ** 2)/2
 
         interval_elapsed_time = self.interval_end - self.interval_start
 
         return total_wait / interval_elapsed_time / 60
 
     def get_cumulative_distribution(self):
+        # returns an array of (wait time in minutes, percentage of interval having wait time less than that) points
+        if self._get_cdf_domain_and_range() is None:
+            return None
+
+        return self.cdf_points
+
+    @property
+    def cdf_points(self):
+        if self._cdf_domain is None:
+            return None
+
+        if self._cdf_points is None:
+            self._cdf_points = np.column_stack((self._cdf_domain, self._cdf_range))
+
+        return self._cdf_points
+
+    def _get_cdf_domain_and_range(self):
         if self.is_empty:
             return None
 
-        if self.cdf_points is not None:
-            return self.cdf_points
+        if self._cdf_domain is not None:
+            return self._cdf_domain, self._cdf_range
 
         interval_elapsed_time = self.interval_end - self.interval_start
 
@@ -188,61 +267,75 @@ class WaitTimeStats:
         has_arrival = len(interval_headways) > 0
 
         if end_wait_time is not None:
-            wait_time_values = np.r_[
-                interval_headways,
+            extra_wait_time_values = [
                 end_wait_time,
                 end_wait_time + end_elapsed_time,
-                0:(1 if has_arrival else 0), # only include 0 wait time if there are any arrivals within the interval
             ]
+            if has_arrival:
+                # only include 0 wait time if there are any arrivals within the interval
+                extra_wait_time_values.insert(0, 0)
         elif has_arrival:
-            wait_time_values = np.r_[0, interval_headways]
+            extra_wait_time_values = [0]
         else:
             return None
 
+        extra_wait_time_values = np.array(extra_wait_time_values)
+        if has_arrival and np.issubdtype(interval_headways.dtype, np.integer):
+            # the extra wait time values are also differences between timestamps,
+            # so they fit in the same 32-bit integer type as the headways
+            extra_wait_time_values = extra_wait_time_values.astype(interval_headways.dtype)
+
         # sorted_wait_time_values are all of the x-coordinates
-        # between which the CDF is piecewise linear
-        sorted_wait_time_values = np.sort(wait_time_values)
+        # between which the CDF is piecewise linear.
+        # Only the headways need to be sorted; the extra wait time values are already in ascending order,
+        # so they can be spliced into the sorted headways at the positions found by binary search.
+        sorted_headways = np.sort(interval_headways.astype(
+            np.result_type(interval_headways, extra_wait_time_values), copy=False
+        ))
+        sorted_wait_time_values = np.insert(
+            sorted_headways,
+            np.searchsorted(sorted_headways, extra_wait_time_values),
+            extra_wait_time_values
+        )
 
         num_wait_time_values = len(sorted_wait_time_values)
 
-        prev_wait_time = None
+        # unique_wait_times are the x-coordinates of the returned points;
+        # first_indexes are the index in sorted_wait_time_values where each unique wait time first occurs.
+        # Since sorted_wait_time_values is already sorted, this avoids the extra sort done by np.unique.
+        is_first_occurrence = np.empty(num_wait_time_values, dtype=bool)
+        is_first_occurrence[0] = True
+        np.not_equal(sorted_wait_time_values[1:], sorted_wait_time_values[:-1], out=is_first_occurrence[1:])
 
-        tot_elapsed = 0 # number of seconds in interval with wait time less than the current wait time
+        first_indexes = np.flatnonzero(is_first_occurrence)
+        unique_wait_times = sorted_wait_time_values[first_indexes]
 
-        # each point is (wait time in seconds, percentage of interval having wait time less than that).
-        # CDF of wait times is piecewise linear between the returned points.
-        points = []
-
-        for i in range(0, len(sorted_wait_time_values)):
-            wait_time = sorted_wait_time_values[i]
-
-            if prev_wait_time is None or wait_time > prev_wait_time:
-                num_occurrences_with_smaller_wait_time = num_wait_time_values - i
-                if end_wait_time is not None and wait_time <= end_wait_time:
-                    # for wait times less than or equal to end_wait_time,
-                    # adjust num_occurrences_with_smaller_headway to avoid counting end_wait_time and end_wait_time + end_elapsed_time
-                    # otherwise, no adjustment needed
-                    num_occurrences_with_smaller_wait_time -= 2
-
-                if prev_wait_time is None:
-                    elapsed = 0
-                else:
-                    # the number of seconds in the interval that someone would wait between prev_wait_time and wait_time
-                    elapsed = (wait_time - prev_wait_time) * num_occurrences_with_smaller_wait_time
+        num_occurrences_with_smaller_wait_time = num_wait_time_values - first_indexes
+        if end_wait_time is not None:
+            # for wait times less than or equal to end_wait_time,
+            # adjust num_occurrences_with_smaller_wait_time to avoid counting end_wait_time and end_wait_time + end_elapsed_time
+            # otherwise, no adjustment needed
+            num_occurrences_with_smaller_wait_time -= 2 * (unique_wait_times <= end_wait_time)
 
-                tot_elapsed += elapsed
+        # the number of seconds in the interval that someone would wait between the previous wait time and each wait time
+        # (zero for the smallest wait time)
+        elapsed = np.diff(unique_wait_times, prepend=unique_wait_times[0]) * num_occurrences_with_smaller_wait_time
 
-                points.append((wait_time / 60, tot_elapsed / interval_elapsed_time))
+        # number of seconds in interval with wait time less than each wait time
+        tot_elapsed = np.cumsum(elapsed)
 
-                prev_wait_time = wait_time
+        # each point is (wait time in minutes, percentage of interval having wait time less than that).
+        # CDF of wait times is piecewise linear between the returned points.
+        cdf_domain = unique_wait_times / 60
+        cdf_range = tot_elapsed / interval_elapsed_time
 
         # if the logic above is correct,
         # the first returned point should be (min wait time, 0.0), and
         # the last returned point should be (max wait time, 1.0)
-        if points[-1][1] != 1 or points[0][1] != 0:
+        if cdf_range[-1] != 1 or cdf_range[0] != 0:
             # should never get here unless the code is broken
             print('Invalid cumulative distribution:', file=sys.stderr)
-            print(points, file=sys.stderr)
+            print(np.column_stack((cdf_domain, cdf_range)), file=sys.stderr)
             print('Interval headways:', file=sys.stderr)
             print(interval_headways, file=sys.stderr)
             print('Sorted wait time values:', file=sys.stderr)
@@ -251,64 +344,78 @@ class WaitTimeStats:
             print(f'End wait time: {end_wait_time}', file=sys.stderr)
             raise AssertionError('Invalid cumulative distribution')
 
-        self.cdf_points = np.array(points)
+        self._cdf_domain = cdf_domain
+        self._cdf_range = cdf_range
+        self._cdf_domain_list = cdf_domain.tolist()
+        self._cdf_range_list = cdf_range.tolist()
 
-        return self.cdf_points
+        return cdf_domain, cdf_range
 
     def get_quantiles(self, quantiles):
-        cdf_points = self.get_cumulative_distribution()
-        if cdf_points is None:
+        cdf = self._get_cdf_domain_and_range()
+        if cdf is None:
             return None
 
-        cdf_domain, cdf_range = cdf_points.T
+        cache_key = tuple(quantiles)
+        if cache_key in self._quantiles_cache:
+            return self._quantiles_cache[cache_key].copy()
 
-        quantile_values = []
+        cdf_domain, cdf_range = cdf
 
-        for quantile in quantiles:
-            segment_end_index = np.searchsorted(cdf_range, quantile)
-            if segment_end_index == 0:
-                quantile_values.append(cdf_domain[0])
-            else:
-                segment_start_index = segment_end_index - 1
-                # linear interpolation to find wait time where value of CDF = quantile
-                quantile_value = cdf_domain[segment_start_index] + \
-                    (quantile - cdf_range[segment_start_index]) / \
-                    (cdf_range[segment_end_index] - cdf_range[segment_start_index]) * \
-                    (cdf_domain[segment_end_index] - cdf_domain[segment_start_index])
-                quantile_values.append(quantile_value)
+        # quantiles outside [0, 1] are limited to the min/max wait time,
+        # rather than extrapolating the first/last CDF segment past the data
+        quantiles = np.clip(np.asarray(quantiles, dtype=float), 0, 1)
+
+        segment_end_indexes = np.searchsorted(cdf_range, quantiles)
+
+        # for quantiles where segment_end_index == 0, the quantile value is cdf_domain[0];
+        # clip the indexes so that the interpolation below can be computed for all quantiles at once
+        clipped_segment_end_indexes = np.clip(segment_end_indexes, 1, len(cdf_range) - 1)
+        segment_start_indexes = clipped_segment_end_indexes - 1
 
-        return np.array(quantile_values)
+        segment_start_domain = cdf_domain[segment_start_indexes]
+        segment_start_range = cdf_range[segment_start_indexes]
+
+        # linear interpolation to find wait time where value of CDF = quantile
+        with np.errstate(divide='ignore', invalid='ignore'):
+            interpolated_values = segment_start_domain + \
+                (quantiles - segment_start_range) / \
+                (cdf_range[clipped_segment_end_indexes] - segment_start_range) * \
+                (cdf_domain[clipped_segment_end_indexes] - segment_start_domain)
+
+        quantile_values = np.where(segment_end_indexes == 0, cdf_domain[0], interpolated_values)
+
+        self._quantiles_cache[cache_key] = quantile_values
+
+        return quantile_values.copy()
 
     def get_percentiles(self, percentiles):
         return self.get_quantiles(np.array(percentiles) / 100)
 
     def get_histogram(self, bins):
-        cdf_points = self.get_cumulative_distribution()
-        if cdf_points is None:
+        cdf = self._get_cdf_domain_and_range()
+        if cdf is None:
             return None
 
-        cdf_domain, cdf_range = cdf_points.T
+        cache_key = tuple(bins)
+        if cache_key in self._histogram_cache:
+            return self._histogram_cache[cache_key].copy()
 
-        histogram = []
-        prev_cumulative_value = None
-        for bin_index, bin_value in enumerate(bins):
-            cumulative_value = self._get_probability_less_than(bin_value, cdf_domain, cdf_range)
+        cdf_domain, cdf_range = cdf
 
-            if prev_cumulative_value is not None:
-                histogram.append(cumulative_value - prev_cumulative_value)
+        # value of CDF at each bin edge (0 below the min wait time, 1 above the max wait time),
+        # using linear interpolation between the CDF points
+        cumulative_values = np.interp(bins, cdf_domain, cdf_range, left=0.0, right=1.0)
 
-            prev_cumulative_value = cumulative_value
+        histogram = self._histogram_cache[cache_key] = np.diff(cumulative_values)
 
-        return np.array(histogram)
+        return histogram.copy()
 
     def get_probability_less_than(self, wait_time):
-        cdf_points = self.get_cumulative_distribution()
-        if cdf_points is None:
+        if self._get_cdf_domain_and_range() is None:
             return None
 
-        cdf_domain, cdf_range = cdf_points.T
-
-        return self._get_probability_less_than(wait_time, cdf_domain, cdf_range)
+        return self._get_probability_less_than(wait_time)
 
     def get_probability_greater_than(self, wait_time):
         prob_less = self.get_probability_less_than(wait_time)
@@ -318,8 +425,13 @@ class WaitTimeStats:
 
         return 1.0 - prob_less
 
-    def _get_probability_less_than(self, wait_time, cdf_domain, cdf_range):
-        segment_end_index = np.searchsorted(cdf_domain, wait_time)
+    def _get_probability_less_than(self, wait_time):
+        # the CDF typically only has a few dozen points, so searching Python lists with bisect
+        # is faster than the overhead of calling np.searchsorted for a single value
+        cdf_domain = self._cdf_domain_list
+        cdf_range = self._cdf_range_list
+
+        segment_end_index = bisect.bisect_left(cdf_domain, wait_time)
 
         if segment_end_index >= len(cdf_domain):
             return 1.0
@@ -343,50 +455,227 @@ class WaitTimeStats:
         )
 
         if self.end_wait_time is not None:
-            arrival_time_values = np.r_[self.interval_time_values, self.interval_end + self.end_wait_time, np.nan]
+            # append the next arrival after the end of the interval
+            interval_time_values = self.interval_time_values
+            num_interval_time_values = len(interval_time_values)
+            next_arrival_time = self.interval_end + self.end_wait_time
+
+            arrival_time_values = np.empty(
+                num_interval_time_values + 1,
+                dtype=np.result_type(interval_time_values, next_arrival_time)
+            )
+            arrival_time_values[:num_interval_time_values] = interval_time_values
+            arrival_time_values[num_interval_time_values] = next_arrival_time
         else:
-            arrival_time_values = np.r_[self.interval_time_values, np.nan]
+            arrival_time_values = self.interval_time_values
+
+        if len(arrival_time_values) == 0:
+            return np.array([])
+
+        # samples after the last arrival have no next arrival, so only the samples
+        # up to and including the time of the last arrival have a wait time
+        num_samples_with_wait = np.searchsorted(sample_time_values, arrival_time_values[-1], side='right')
+        sample_time_values = sample_time_values[:num_samples_with_wait]
 
         next_arrival_indexes = np.searchsorted(arrival_time_values, sample_time_values, 'left')
 
-        next_arrival_times = arrival_time_values[next_arrival_indexes]
+        return (arrival_time_values[next_arrival_indexes] - sample_time_values) / 60
 
-        waits = next_arrival_times - sample_time_values
+# BatchWaitTimeStats computes statistics for many intervals over the same
+# sorted array of arrival or departure times (Unix timestamps in seconds),
+# equivalent to calling get_stats(time_values, start_times[i], end_times[i]) for each interval i,
+# but computed with a few vectorized numpy operations instead of constructing
+# a separate WaitTimeStats object for each interval.
+#
+# start_times and end_times are parallel arrays; a value of None (or NaN)
+# means that the interval is not limited at the start or end.
+#
+# Per-interval values are stored as parallel arrays (interval_starts, interval_ends,
+# start_arrival_indexes, end_arrival_indexes, end_wait_times, end_elapsed_times).
+# Stats for intervals that are empty are returned as NaN.
+#
+# If segment_offsets is provided, time_values is the concatenation of several sorted
+# arrays (e.g. one per stop), and interval i only uses the time values in
+# time_values[segment_offsets[i]:segment_offsets[i+1]].
+# segment_offsets must be non-decreasing, have one more element than start_times,
+# and span the whole array (segment_offsets[0] == 0 and segment_offsets[-1] == len(time_values)).
+#
+class BatchWaitTimeStats:
+    def __init__(self, time_values, start_times, end_times, segment_offsets = None):
+        # time_values may be any sequence (e.g. a list); it is converted to a numpy array
+        time_values = self.time_values = np.asarray(time_values)
 
-        return waits[np.logical_not(np.isnan(waits))] / 60
+        start_times = np.asarray(start_times, dtype=float)
+        end_times = np.asarray(end_times, dtype=float)
 
-DefaultVersion = 'v1b'
+        num_intervals = len(start_times)
+        num_time_values = len(time_values)
 
-class CachedWaitTimes:
-    def __init__(self, wait_times_data):
-        self.wait_times_data = wait_times_data
+        if segment_offsets is None:
+            segment_starts = np.zeros(num_intervals, dtype=np.int64)
+            segment_ends = np.full(num_intervals, num_time_values, dtype=np.int64)
+        else:
+            segment_offsets = np.asarray(segment_offsets, dtype=np.int64)
 
-    def get_value(self, route_id, direction_id, stop_id):
-        routes_data = self.wait_times_data['routes']
+            if len(segment_offsets) != num_intervals + 1 or segment_offsets[0] != 0 or \
+                    segment_offsets[-1] != num_time_values or np.any(np.diff(segment_offsets) < 0):
+                raise ValueError(
+                    f"Invalid segment offsets: expected {num_intervals + 1} non-decreasing offsets "
+                    f"from 0 to {num_time_values}, got {segment_offsets}"
+                )
 
-        if route_id not in routes_data:
-            return None
+            segment_starts = segment_offsets[:-1]
+            segment_ends = segment_offsets[1:]
 
-        route_data = routes_data[route_id]
+        has_time_values = segment_ends > segment_starts
 
-        if direction_id not in route_data:
-            return None
+        if not np.any(has_time_values):
+            self.is_empty = np.full(num_intervals, True)
+            return
 
-        direction_data = route_data[direction_id]
+        first_bus_times = time_values[np.minimum(segment_starts, num_time_values - 1)]
+        last_bus_times = time_values[np.maximum(segment_ends - 1, 0)]
 
-        if stop_id not in direction_data:
-            return None
+        # if start_time/end_time is outside the range of arrival times, limit interval to first/last arrival time
+        # (np.fmax and np.fmin ignore NaN values)
+        interval_starts = np.fmax(first_bus_times, start_times).astype(np.int64)
+        interval_ends = np.maximum(np.fmin(last_bus_times, end_times), interval_starts).astype(np.int64)
+
+        if segment_offsets is None:
+            start_arrival_indexes = np.searchsorted(time_values, interval_starts, side='left')
+            end_arrival_indexes = np.searchsorted(time_values, interval_ends, side='left')
+        else:
+            # To search within each segment using a single np.searchsorted call,
+            # offset the time values in each segment by a multiple of the total time span,
+            # so that the keys are sorted across all segments. Interval starts and ends are searched
+            # within the range of times in their own segment, so they are offset in the same way.
+            # (Starts are already at least the first time in the segment, but may be after the last time,
+            # in which case the interval is empty; limiting them to the last time keeps the search key
+            # within the segment's own range without changing the result for non-empty intervals.)
+            min_time = np.min(time_values)
+            time_span = np.max(time_values) - min_time + 1
+            segment_keys = np.repeat(np.arange(num_intervals) * time_span, segment_ends - segment_starts)
+            search_keys = (time_values - min_time) + segment_keys
+
+            interval_keys = np.arange(num_intervals) * time_span - min_time
+            start_arrival_indexes = np.searchsorted(
+                search_keys, np.minimum(interval_starts, last_bus_times) + interval_keys, side='left'
+            )
+            end_arrival_indexes = np.searchsorted(
+                search_keys, np.minimum(interval_ends, last_bus_times) + interval_keys, side='left'
+            )
+
+        has_arrival = end_arrival_indexes > start_arrival_indexes
+
+        # time of the last bus arriving within each interval (only meaningful if has_arrival)
+        last_arrival_times = time_values[np.maximum(end_arrival_indexes - 1, 0)]
+
+        # end elapsed_time is the number of seconds between when the last bus arrives within each interval and the end of the interval
+        end_elapsed_times = np.where(has_arrival, interval_ends - last_arrival_times, interval_ends - interval_starts)
+
+        # end_wait_time is the number of seconds after the end of each interval before the next bus arrives
+        # (only meaningful if has_end_wait_time)
+        has_end_wait_time = end_arrival_indexes < segment_ends
+        end_wait_times = time_values[np.minimum(end_arrival_indexes, num_time_values - 1)] - interval_ends
+
+        no_next_arrival = np.logical_not(has_end_wait_time) & (end_elapsed_times > 0)
+        end_elapsed_times = np.where(no_next_arrival, 0, end_elapsed_times)
+        interval_ends = np.where(no_next_arrival, last_arrival_times, interval_ends)
+
+        # sum of squared headways between buses within each interval, computed from the cumulative sum of
+        # squared headways over all of time_values, so each interval needs only O(1) work.
+        # The first headway in each interval is measured from the start of the interval.
+        # (Headways between the last time in one segment and the first time in the next segment
+        # are never included, since each interval only covers headways within its own segment.)
+        # headways are squared in the 64-bit accumulator type, since squares of 32-bit headways may overflow 32 bits
+        sum_dtype = np.result_type(time_values, np.int64)
+        headways = np.diff(time_values).astype(sum_dtype, copy=False)
+        cumulative_squared_headways = np.zeros(num_time_values, dtype=sum_dtype)
+        np.cumsum(headways * headways, out=cumulative_squared_headways[1:])
+
+        first_headways = time_values[np.minimum(start_arrival_indexes, num_time_values - 1)] - interval_starts
+
+        self.sum_squared_headways = np.where(
+            has_arrival,
+            first_headways * first_headways +
+                cumulative_squared_headways[np.maximum(end_arrival_indexes - 1, 0)] -
+                cumulative_squared_headways[np.minimum(start_arrival_indexes, num_time_values - 1)],
+            0
+        )
+
+        self.interval_starts = interval_starts
+        self.interval_ends = interval_ends
+        self.start_arrival_indexes = start_arrival_indexes
+        self.end_arrival_indexes = end_arrival_indexes
+        self.end_elapsed_times = end_elapsed_times
+        self.end_wait_times = end_wait_times
+        self.has_end_wait_time = has_end_wait_time
+
+        self.is_empty = ((interval_ends - interval_starts) <= 0) | np.logical_not(has_time_values)
+
+    def get_averages(self):
+        if np.all(self.is_empty):
+            return np.full(len(self.is_empty), np.nan)
+
+        end_elapsed_times = self.end_elapsed_times
 
-        return direction_data[stop_id]
+        # for the time between each bus that arrives within the interval, total wait time is area of a triangle
+        total_waits = self.sum_squared_headways / 2
+
+        # for the next arrival after the end of the interval,
+        # total wait time is the area of a rectangle plus the area of a triangle
+        total_waits = total_waits + np.where(
+            self.has_end_wait_time,
+            (self.end_wait_times * end_elapsed_times) + (end_elapsed_times ** 2) / 2,
+            0
+        )
+
+        interval_elapsed_times = self.interval_ends - self.interval_starts
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            averages = total_waits / interval_elapsed_times / 60
+
+        return np.where(self.is_empty, np.nan, averages)
+
+DefaultVersion = 'v1b'
+
+class CachedWaitTimes:
+    def __init__(self, wait_times_data):
+        self.wait_times_data = wait_times_data
+
+        # flatten the nested routes -> directions -> stops dicts into a single dict
+        # keyed by (route_id, direction_id, stop_id), so each lookup is a single hash lookup
+        self.values_by_stop = {
+            (route_id, direction_id, stop_id): value
+            for route_id, route_data in wait_times_data['routes'].items()
+            for direction_id, direction_data in route_data.items()
+            for stop_id, value in direction_data.items()
+        }
+
+    def get_value(self, route_id, direction_id, stop_id):
+        return self.values_by_stop.get((route_id, direction_id, stop_id))
+
+    def get_values_batch(self, route_ids, direction_ids, stop_ids):
+        # Returns a list of values for parallel lists of route_ids, direction_ids, and stop_ids,
+        # with None for stops that have no cached value.
+        values_by_stop = self.values_by_stop
+        return [values_by_stop.get(key) for key in zip(route_ids, direction_ids, stop_ids)]
+
+# parsed wait times are kept in memory so that resolving several stats for the same
+# agency/date/stat_id/time range does not need to read and parse the same file again.
+# the file's modification time is part of the key, so a cache file that is rewritten
+# (e.g. by compute_wait_times.py or compute_new.py) is read again.
+@functools.lru_cache(maxsize=8)
+def load_cached_wait_times(cache_path, mtime_ns) -> CachedWaitTimes:
+    with open(cache_path, "rb") as f:
+        return CachedWaitTimes(json_loads(f.read()))
 
 def get_cached_wait_times(agency_id, d: date, stat_id: str, start_time_str = None, end_time_str = None, version = DefaultVersion) -> CachedWaitTimes:
 
     cache_path = get_cache_path(agency_id, d, stat_id, start_time_str, end_time_str, version)
 
     try:
-        with open(cache_path, "r") as f:
-            text = f.read()
-            return CachedWaitTimes(json.loads(text))
+        return load_cached_wait_times(cache_path, os.stat(cache_path).st_mtime_ns)
     except FileNotFoundError as err:
         pass
 
@@ -394,23 +683,40 @@ def get_cached_wait_times(agency_id, d: date, stat_id: str, start_time_str = Non
     s3_path = get_s3_path(agency_id, d, stat_id, start_time_str, end_time_str, version)
 
     s3_url = f"http://{s3_bucket}.s3.amazonaws.com/{s3_path}"
-    r = requests.get(s3_url)
-
-    if r.status_code == 404:
-        raise FileNotFoundError(f"{s3_url} not found")
-    if r.status_code == 403:
-        raise FileNotFoundError(f"{s3_url} not found or access denied")
-    if r.status_code != 200:
-        raise Exception(f"Error fetching {s3_url}: HTTP {r.status_code}: {r.text}")
-
-    data = json.loads(r.text)
-
-    cache_dir = Path(cache_path).parent
-    if not cache_dir.exists():
-        cache_dir.mkdir(parents = True, exist_ok = True)
-
-    with open(cache_path, "w") as f:
-        f.write(r.text)
+    with requests.get(s3_url, stream=True) as r:
+        if r.status_code == 404:
+            raise FileNotFoundError(f"{s3_url} not found")
+        if r.status_code == 403:
+            raise FileNotFoundError(f"{s3_url} not found or access denied")
+        if r.status_code != 200:
+            raise Exception(f"Error fetching {s3_url}: HTTP {r.status_code}: {r.text}")
+
+        cache_dir = Path(cache_path).parent
+        if not cache_dir.exists():
+            cache_dir.mkdir(parents = True, exist_ok = True)
+
+        # stream the response to the cache file instead of buffering the whole response in memory.
+        # the S3 object is stored with Content-Encoding: gzip, so iter_content returns the decompressed JSON.
+        # write to a uniquely named temporary file first, so that a failed download doesn't leave a partial
+        # cache file, and concurrent downloads of the same file don't write to the same temporary file.
+        # the file is created with mode 0o666 (minus the umask), the same as files written with open().
+        tmp_cache_path = f'{cache_path}.{uuid.uuid4().hex}.tmp'
+        replaced = False
+        try:
+            with os.fdopen(os.open(tmp_cache_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), "wb") as f:
+                for chunk in r.iter_content(chunk_size=65536):
+                    f.write(chunk)
+
+            # parse this request's own temporary file, since another request may replace cache_path
+            with open(tmp_cache_path, "rb") as f:
+                data = json_loads(f.read())
+
+            os.replace(tmp_cache_path, cache_path)
+            replaced = True
+        finally:
+            # also runs on KeyboardInterrupt, so the temporary file is never left behind
+            if not replaced and os.path.exists(tmp_cache_path):
+                os.remove(tmp_cache_path)
 
     return CachedWaitTimes(data)
 
@@ -426,23 +732,26 @@ def get_s3_path(agency_id: str, d: date, stat_id: str, start_time_str, end_time_
     date_path = d.strftime("%Y/%m/%d")
     return f"wait-times/{version}/{agency_id}/{date_path}/wait-times_{version}_{agency_id}_{date_str}_{stat_id}{time_range_path}.json.gz"
 
+SafePathComponentRe = re.compile(r'^[\w\-]+$')
+SafeTimeRangePathRe = re.compile(r'^[\w\-\+]*$')
+
 def get_cache_path(agency_id: str, d: date, stat_id: str, start_time_str, end_time_str, version = DefaultVersion) -> str:
     time_range_path = get_time_range_path(start_time_str, end_time_str)
 
     date_str = str(d)
-    if re.match('^[\w\-]+$', agency_id) is None:
+    if SafePathComponentRe.match(agency_id) is None:
         raise Exception(f"Invalid agency: {agency_id}")
 
-    if re.match('^[\w\-]+$', date_str) is None:
+    if SafePathComponentRe.match(date_str) is None:
         raise Exception(f"Invalid date: {date_str}")
 
-    if re.match('^[\w\-]+$', version) is None:
+    if SafePathComponentRe.match(version) is None:
         raise Exception(f"Invalid version: {version}")
 
-    if re.match('^[\w\-]+$', stat_id) is None:
+    if SafePathComponentRe.match(stat_id) is None:
         raise Exception(f"Invalid stat id: {stat_id}")
 
-    if re.match('^[\w\-\+]*$', time_range_path) is None:
+    if SafeTimeRangePathRe.match(time_range_path) is None:
         raise Exception(f"Invalid time range: {time_range_path}")
 
     return f'{util.get_data_dir()}/wait-times_{version}_{agency_id}/{date_str}/wait-times_{version}_{agency_id}_{date_str}_{stat_id}{time_range_path}.json'